@@ -17,11 +17,27 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 
+import os
 import sys
 import re
+from collections import OrderedDict
 from shapely.geometry import Point, Polygon, LineString
 
 
+# Regular expressions of source details and source vertex blocks
+_SRC_RE = re.compile(r'&ADMS_SOURCE_DETAILS([^&/]+)/', re.DOTALL)
+_VTX_RE = re.compile(r'&ADMS_SOURCE_VERTEX([^&/]+)/', re.DOTALL)
+_VTXX_RE = re.compile(r'SourceVertexX\s+=\s+([0-9eE+-.]+)\s')
+_VTXY_RE = re.compile(r'SourceVertexY\s+=\s+([0-9eE+-.]+)\s')
+_SRCNAM_RE = re.compile(r"""SrcName\s+=\s+["'](.*)["']""")
+_SRCTYP_RE = re.compile(r'SrcSourceType\s+=\s+(.*)\s')
+_SRCPOL_RE = re.compile(r"""SrcPollutants\s+=\s+(["'].*["'])\s""", re.DOTALL)
+_SRCEMI_RE = re.compile(r"SrcPolEmissionRate\s+=\s+([^Src]+)", re.DOTALL)
+_SRCNVX_RE = re.compile(r'SrcNumVertices\s+=\s+([0-9]+)\s')
+_SRCX_RE = re.compile(r'SrcX1\s+=\s+([0-9eE+-.]+)\s')
+_SRCY_RE = re.compile(r'SrcY1\s+=\s+([0-9eE+-.]+)\s')
+
+
 def listfromstr(s):
     """Return list of elements from "'xxx' 'xxx' 'xxx'" string."""
     return s.strip().replace("'", "").replace('"', '').split()
@@ -67,117 +83,100 @@ class ADMSUrbanUPL:
             len(self.src_roads), len(self.src_points), len(self.src_vols),
             len(self.src_surfs), len(self.src_cads))
 
-    def read(self, fn):
-        """Read a UPL ADMS-Urban file."""
+    def read(self, fn, types=None, bbox=None, pollutants=None):
+        """Read a UPL ADMS-Urban file.
+
+        Sources can be filtered while parsing, the vertices of skipped
+        sources are never converted:
+
+        * `types`: source types to keep (0: point, 1: surface, 2: volume,
+          4: road, 5: cadastre),
+        * `bbox`: (xmin, ymin, xmax, ymax), keep sources whose extent
+          intersects this box,
+        * `pollutants`: pollutants whose emission rates are kept.
+        """
         
         # Read file
         with open(fn, 'r') as f:
-            lines = f.readlines()
+            txt = f.read()
 
         # Read source details and source vertex blocks
-        src_re = re.compile(r'&ADMS_SOURCE_DETAILS([^&/]+)/', re.DOTALL)
-        src_blocks = re.findall(src_re, "".join(lines))
-        
-        vtx_re = re.compile(r'&ADMS_SOURCE_VERTEX([^&/]+)/', re.DOTALL)
-        vtx_blocks = re.findall(vtx_re, "".join(lines))
-        
-        # Read vertices informations
-        vertices = []
-        for vtx_block in vtx_blocks:
-        
-            # X and Y
-            vtxx_re = re.compile(r'SourceVertexX\s+=\s+([0-9eE+-.]+)\s')
-            vtxx = float(re.findall(vtxx_re, vtx_block)[0])
-
-            vtxy_re = re.compile(r'SourceVertexY\s+=\s+([0-9eE+-.]+)\s')
-            vtxy = float(re.findall(vtxy_re, vtx_block)[0])
-            
-            vertices.append((vtxx, vtxy))
+        src_blocks = re.findall(_SRC_RE, txt)
+        vtx_blocks = re.findall(_VTX_RE, txt)
+        ivtx = 0  # index of the first vertex block of the current source
         
         # Read source informations
         for src_block in src_blocks:
             
-            # Source name
-            srcnam_re = re.compile(r"""SrcName\s+=\s+["'](.*)["']""")
-            srcnam = re.findall(srcnam_re, src_block)[0].strip()
-            
             # Source type
-            srctyp_re = re.compile(r'SrcSourceType\s+=\s+(.*)\s')
-            srctyp = int(re.findall(srctyp_re, src_block)[0])
+            srctyp = int(re.findall(_SRCTYP_RE, src_block)[0])
+            if srctyp not in (0, 1, 2, 4, 5):
+                raise ValueError(
+                    "cannot understand srctype = {}".format(srctyp))
             
-            # List of pollutants
-            srcpol_re = re.compile(r"""SrcPollutants\s+=\s+(["'].*["'])\s""",
-                                   re.DOTALL)
-            srcpol = [e.strip()
-                      for e in listfromstr(re.findall(srcpol_re, src_block)[0])]
+            # Number of vertices and vertex blocks of this source
+            srcnvx = int(re.findall(_SRCNVX_RE, src_block)[0])
+            if srctyp != 0:
+                src_vtx_blocks = vtx_blocks[ivtx:ivtx + srcnvx]
+                ivtx += srcnvx
             
-            # Emission rate of pollutants
-            srcemi_re = re.compile(r"SrcPolEmissionRate\s+=\s+([^Src]+)",
-                                   re.DOTALL)
-            srcemi = [float(e)
-                      for e
-                      in re.findall(srcemi_re, src_block)[0].strip().split(' ')
-                      if e]
+            # Filter by type
+            if types is not None and srctyp not in types:
+                continue
             
-            # Number of vertices
-            srcnvx_re = re.compile(r'SrcNumVertices\s+=\s+([0-9]+)\s')
-            srcnvx = int(re.findall(srcnvx_re, src_block)[0])
+            # Coordinates
+            if srctyp == 0:  # point source
+                srcx = float(re.findall(_SRCX_RE, src_block)[0])
+                srcy = float(re.findall(_SRCY_RE, src_block)[0])
+                coo = [(srcx, srcy)]
+            else:
+                coo = [(float(re.findall(_VTXX_RE, vtx_block)[0]),
+                        float(re.findall(_VTXY_RE, vtx_block)[0]))
+                       for vtx_block in src_vtx_blocks]
             
-            # X and Y
-            srcx_re = re.compile(r'SrcX1\s+=\s+([0-9eE+-.]+)\s')
-            srcx = float(re.findall(srcx_re, src_block)[0])
-            srcy_re = re.compile(r'SrcY1\s+=\s+([0-9eE+-.]+)\s')
-            srcy = float(re.findall(srcy_re, src_block)[0])
+            # Filter by extent
+            if bbox is not None:
+                xs = [e[0] for e in coo]
+                ys = [e[1] for e in coo]
+                if (max(xs) < bbox[0] or max(ys) < bbox[1] or
+                        min(xs) > bbox[2] or min(ys) > bbox[3]):
+                    continue
+            
+            # Source name
+            srcnam = re.findall(_SRCNAM_RE, src_block)[0].strip()
+            
+            # List of pollutants and emission rate of pollutants
+            srcpol = [e.strip()
+                      for e in listfromstr(re.findall(_SRCPOL_RE,
+                                                      src_block)[0])]
+            srcemi = [e for e
+                      in re.findall(_SRCEMI_RE, src_block)[0].strip().split(' ')
+                      if e]
+            if pollutants is not None:
+                srcemi = [emi for pol, emi in zip(srcpol, srcemi)
+                          if pol in pollutants]
+                srcpol = [pol for pol in srcpol if pol in pollutants]
+            srcemi = [float(e) for e in srcemi]
             
             # Geometry
             if srctyp == 0:  # point source
-                geom = Point(srcx, srcy)
+                geom = Point(coo[0])
                 self.src_points.append(ADMSUrbanSource(srcnam, srctyp, srcpol,
                                                        srcemi, geom))
-                del geom
 
-            elif srctyp == 1:  # surface source
-                coo = []
-                for i in range(srcnvx):
-                    coo.append(vertices.pop(0))
-                coo.append(coo[0])  # close polygon
-                geom = Polygon(coo)
-                self.src_surfs.append(ADMSUrbanSource(srcnam, srctyp, srcpol,
-                                                      srcemi, geom))
-                del coo, geom
-            
-            elif srctyp == 2:  # volume source
-                coo = []
-                for i in range(srcnvx):
-                    coo.append(vertices.pop(0))
-                coo.append(coo[0])  # close polygon
-                geom = Polygon(coo)
-                self.src_vols.append(ADMSUrbanSource(srcnam, srctyp, srcpol,
-                                                     srcemi, geom))
-                del coo, geom
-            
             elif srctyp == 4:  # road source
-                coo = []
-                for i in range(srcnvx):
-                    coo.append(vertices.pop(0))
                 geom = LineString(coo)
                 self.src_roads.append(ADMSUrbanSource(srcnam, srctyp, srcpol,
                                                       srcemi, geom))
-                del coo, geom
-            
-            elif srctyp == 5:  # cadastre
-                coo = []
-                for i in range(srcnvx):
-                    coo.append(vertices.pop(0))
+
+            else:  # surface, volume or cadastre source
                 coo.append(coo[0])  # close polygon
                 geom = Polygon(coo)
-                self.src_cads.append(ADMSUrbanSource(srcnam, srctyp, srcpol,
-                                                     srcemi, geom))
-                del coo, geom
-            
-            else:
-                raise ValueError(
-                    "cannot understand srctype = {}".format(srctyp))
+                srcs = {1: self.src_surfs, 2: self.src_vols,
+                        5: self.src_cads}[srctyp]
+                srcs.append(ADMSUrbanSource(srcnam, srctyp, srcpol, srcemi,
+                                            geom))
+            del coo, geom
 
     @property
     def sources(self):
@@ -263,6 +262,225 @@ class ADMSUrbanUPL:
                     emis=",".join(emis)))
 
 
+def _coords(geom):
+    """Return the tuple of coordinates defining a source geometry."""
+    if geom.geom_type == 'Polygon':
+        return tuple(geom.exterior.coords)
+    return tuple(geom.coords)
+
+
+class ADMSUrbanSourceDiff:
+    """Difference of one ADMS-Urban source between two UPL."""
+
+    def __init__(self, srcname, status, srctyp, srcdelta, geom_changed, geom):
+        self.srcname = srcname
+        self.status = status  # 'added', 'removed' or 'changed'
+        self.srctyp = srctyp
+        self.srcdelta = srcdelta  # {pollutant: new - old}
+        self.geom_changed = geom_changed
+        self.geom = geom
+
+    def __repr__(self):
+        return "<ADMSUrbanSourceDiff(status={})>".format(self.status)
+
+    def __str__(self):
+        return ("ADMSUrbanSourceDiff(\n  name = {}\nstatus = {}\n  type = {}\n"
+                " delta = {}\n  geom = {}\n)").format(
+            self.srcname, self.status, self.srctyp, self.srcdelta,
+            "changed" if self.geom_changed else "unchanged")
+
+
+class ADMSUrbanDiff:
+    """Differences between two ADMS-Urban UPL.
+
+    Sources are matched by name, which must be unique in each UPL. Added
+    sources have a delta equal to their emissions, removed sources a delta
+    equal to minus their emissions. Deltas of pollutants a source does not
+    emit in both UPL are 0.
+    """
+
+    def __init__(self, old, new):
+        self.added = []
+        self.removed = []
+        self.changed = []
+
+        # Index sources by name
+        old_idx = self._index(old)
+        new_idx = self._index(new)
+
+        for srcname, src in new_idx.items():
+            emi = dict(zip(src.srcpol, src.srcemi))
+            if srcname not in old_idx:
+                self.added.append(ADMSUrbanSourceDiff(
+                    srcname, 'added', src.srctyp, emi, True, src.geom))
+                continue
+
+            # Emission deltas
+            oldsrc = old_idx[srcname]
+            oldemi = dict(zip(oldsrc.srcpol, oldsrc.srcemi))
+            delta = {}
+            for pol in set(emi) | set(oldemi):
+                delta[pol] = emi.get(pol, 0.) - oldemi.get(pol, 0.)
+
+            # Geometry
+            geom_changed = (src.srctyp != oldsrc.srctyp or
+                            _coords(src.geom) != _coords(oldsrc.geom))
+
+            if geom_changed or set(emi) != set(oldemi) or any(delta.values()):
+                self.changed.append(ADMSUrbanSourceDiff(
+                    srcname, 'changed', src.srctyp, delta, geom_changed,
+                    src.geom))
+
+        for srcname, src in old_idx.items():
+            if srcname not in new_idx:
+                delta = dict((pol, -emi)
+                             for pol, emi in zip(src.srcpol, src.srcemi))
+                self.removed.append(ADMSUrbanSourceDiff(
+                    srcname, 'removed', src.srctyp, delta, True, src.geom))
+
+        # Same pollutants for all differences
+        pols = self.pollutants
+        for srcdiff in self.sources:
+            for pol in pols:
+                srcdiff.srcdelta.setdefault(pol, 0.)
+
+    @staticmethod
+    def _index(upl):
+        """Sources of an UPL indexed by name."""
+        idx = {}
+        for src in upl.sources:
+            if src.srcname in idx:
+                raise ValueError(
+                    "duplicate source name = {}".format(src.srcname))
+            idx[src.srcname] = src
+        return idx
+
+    def __repr__(self):
+        return "<{}>".format(self)
+
+    def __str__(self):
+        return "ADMSUrbanDiff({} added, {} removed, {} changed)".format(
+            len(self.added), len(self.removed), len(self.changed))
+
+    @property
+    def sources(self):
+        """Generator of all differences."""
+        for srcdiffs in (self.added, self.removed, self.changed):
+            for srcdiff in srcdiffs:
+                yield srcdiff
+
+    def __iter__(self):
+        """Iterator of all differences."""
+        return self.sources
+
+    def __len__(self):
+        """Numbers of differences."""
+        return len(self.added) + len(self.removed) + len(self.changed)
+
+    @property
+    def pollutants(self):
+        """List of pollutants from all differences."""
+        pols = set([pol for e in self.sources for pol in e.srcdelta])
+        return sorted(pols)
+
+    def to_csv(self, fn):
+        """Export differences into CSV file."""
+        pols = self.pollutants
+        with open(fn, 'w') as f:
+            f.write('src_name,status,src_type,geom_changed,' +
+                    ','.join(pols) + '\n')
+            for srcdiff in self.sources:
+                deltas = [str(srcdiff.srcdelta[p]) if p in srcdiff.srcdelta
+                          else "" for p in pols]
+                f.write('{srcname},{status},{srctype},{geom},{deltas}\n'.format(
+                    srcname=srcdiff.srcname,
+                    status=srcdiff.status,
+                    srctype=srcdiff.srctyp,
+                    geom=int(srcdiff.geom_changed),
+                    deltas=",".join(deltas)))
+
+
+def diff(old, new):
+    """Differences between two `ADMSUrbanUPL`, see `ADMSUrbanDiff`."""
+    return ADMSUrbanDiff(old, new)
+
+
+class ADMSUrbanUPLCache:
+    """LRU cache of parsed UPL.
+
+    UPL are keyed by path, modification time and filters of
+    `ADMSUrbanUPL.read`. `max_bytes` is the memory budget, the size of an UPL
+    is estimated from its numbers of sources, coordinates and emission rates
+    (about 1.5 kB per source). An UPL larger than the budget is not cached.
+    """
+
+    # Estimated memory size of a source, a coordinate and an emission rate
+    _src_bytes = 1024
+    _coo_bytes = 64
+    _emi_bytes = 96
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._upls = OrderedDict()  # {key: (upl, nbytes)}, last is newest
+
+    def __repr__(self):
+        return "<ADMSUrbanUPLCache({} UPL, {} bytes)>".format(
+            len(self._upls), self.nbytes)
+
+    def __len__(self):
+        """Numbers of cached UPL."""
+        return len(self._upls)
+
+    @classmethod
+    def sizeof(cls, upl):
+        """Estimated memory size of an UPL in bytes."""
+        return sum(cls._src_bytes + cls._coo_bytes * len(_coords(src.geom)) +
+                   cls._emi_bytes * len(src.srcemi)
+                   for src in upl.sources)
+
+    @staticmethod
+    def _key(fn, types=None, bbox=None, pollutants=None):
+        """Key of an UPL read with some filters."""
+        return (os.path.abspath(fn), os.path.getmtime(fn),
+                None if types is None else tuple(sorted(types)),
+                None if bbox is None else tuple(bbox),
+                None if pollutants is None else tuple(sorted(pollutants)))
+
+    def cached(self, fn, **kwargs):
+        """Whether an UPL read with some filters is cached."""
+        return self._key(fn, **kwargs) in self._upls
+
+    def read(self, fn, types=None, bbox=None, pollutants=None):
+        """Return the cached UPL or read it, see `ADMSUrbanUPL.read`."""
+        key = self._key(fn, types=types, bbox=bbox, pollutants=pollutants)
+
+        if key in self._upls:
+            upl, nbytes = self._upls.pop(key)
+            self._upls[key] = (upl, nbytes)  # most recently used
+            return upl
+
+        upl = ADMSUrbanUPL()
+        upl.read(fn, types=types, bbox=bbox, pollutants=pollutants)
+        nbytes = self.sizeof(upl)
+        if nbytes > self.max_bytes:
+            return upl  # too large to be cached
+        self._upls[key] = (upl, nbytes)
+        self.nbytes += nbytes
+
+        # Remove least recently used UPL
+        while self.nbytes > self.max_bytes:
+            _, nbytes = self._upls.popitem(last=False)[1]
+            self.nbytes -= nbytes
+
+        return upl
+
+    def clear(self):
+        """Remove all cached UPL."""
+        self._upls.clear()
+        self.nbytes = 0
+
+
 if __name__ == '__main__':
 
     # Testing...
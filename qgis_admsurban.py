@@ -23,8 +23,6 @@ from qgis.core import *
 from qgis.gui import QgsGenericProjectionSelector
 from qgis.gui import QgsMessageBar
 from qgis.utils import iface
-import resources_rc
-import admsurban
 
 
 def msg_info(msg, duration=3):
@@ -38,46 +36,203 @@ def msg_error(msg):
     mb = iface.messageBar()
     mb.pushMessage("ADMS-Urban", str(msg), level=QgsMessageBar.CRITICAL)
     
-    
+
+
+class ADMSUrbanOpenDialog(QDialog):
+    """Filters of the sources to read from an UPL."""
+
+    srctypes = ((0, "Point"), (4, "Road"), (1, "Area"), (2, "Volume"),
+                (5, "Cadastre"))
+
+    def __init__(self, parent=None):
+        QDialog.__init__(self, parent)
+        self.setWindowTitle("Open ADMS-Urban UPL file")
+        layout = QVBoxLayout(self)
+
+        # Source types
+        gbtypes = QGroupBox("Source types", self)
+        ltypes = QHBoxLayout(gbtypes)
+        self.cbtypes = {}
+        for srctyp, label in self.srctypes:
+            cb = QCheckBox(label, gbtypes)
+            cb.setChecked(True)
+            ltypes.addWidget(cb)
+            self.cbtypes[srctyp] = cb
+        layout.addWidget(gbtypes)
+
+        # Extent
+        self.gbbbox = QGroupBox("Extent (file coordinates)", self)
+        self.gbbbox.setCheckable(True)
+        self.gbbbox.setChecked(False)
+        lbbox = QGridLayout(self.gbbbox)
+        self.lebbox = []
+        for i, label in enumerate(("xmin", "ymin", "xmax", "ymax")):
+            le = QLineEdit(self.gbbbox)
+            le.setValidator(QDoubleValidator(le))
+            lbbox.addWidget(QLabel(label, self.gbbbox), i // 2, 2 * (i % 2))
+            lbbox.addWidget(le, i // 2, 2 * (i % 2) + 1)
+            self.lebbox.append(le)
+        layout.addWidget(self.gbbbox)
+
+        # Pollutants
+        layout.addWidget(QLabel("Pollutants (separated by spaces, "
+                                "empty for all)", self))
+        self.lepols = QLineEdit(self)
+        layout.addWidget(self.lepols)
+
+        buttons = QDialogButtonBox(
+            QDialogButtonBox.Ok | QDialogButtonBox.Cancel, Qt.Horizontal, self)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        layout.addWidget(buttons)
+
+    def accept(self):
+        """Check the filters before closing the dialog."""
+        if self.types == []:
+            QMessageBox.warning(self, "ADMS-Urban",
+                                "Select at least one source type !")
+            return
+        if self.gbbbox.isChecked():
+            try:
+                xmin, ymin, xmax, ymax = [float(le.text())
+                                          for le in self.lebbox]
+            except ValueError:
+                QMessageBox.warning(self, "ADMS-Urban",
+                                    "Invalid extent coordinates !")
+                return
+            if xmin > xmax or ymin > ymax:
+                QMessageBox.warning(self, "ADMS-Urban",
+                                    "xmin > xmax or ymin > ymax !")
+                return
+        QDialog.accept(self)
+
+    @property
+    def types(self):
+        """Selected source types, None if all are selected."""
+        types = [srctyp for srctyp, cb in self.cbtypes.items()
+                 if cb.isChecked()]
+        if len(types) == len(self.cbtypes):
+            return None
+        return types
+
+    @property
+    def bbox(self):
+        """Selected extent, None if not set (checked by `accept`)."""
+        if not self.gbbbox.isChecked():
+            return None
+        return tuple(float(le.text()) for le in self.lebbox)
+
+    @property
+    def pollutants(self):
+        """Selected pollutants, None if not set."""
+        pols = str(self.lepols.text()).replace(',', ' ').split()
+        return pols or None
+
+
 class QGisADMSUrbanViewer:
     def __init__(self, iface):
         # Save reference to the QGIS interface
         self.iface = iface
         # initialize plugin directory
         self.plugin_dir = os.path.dirname(__file__)
-        # initialize locale
-        locale = QSettings().value("locale/userLocale")[0:2]
-        localepath = os.path.join(
-            self.plugin_dir, 'i18n', 'admsurban_{}.qm'.format(locale))
-
-        if os.path.exists(localepath):
-            self.translator = QTranslator()
-            self.translator.load(localepath)
-
-            if qVersion() > '4.3.3':
-                QCoreApplication.installTranslator(self.translator)
+        # parser module and parsed UPL, loaded on first use
+        self.admsurban = None
+        self.cache = None
+        # {layer id: ids of the layers loaded with it}
+        self.loads = {}
 
     def initGui(self):
         # Add toolbar 
         self.toolbar = self.iface.addToolBar("ADMS-Urban")
         
         # Create action that will start plugin configuration
-        self.action_open = QAction(QIcon(":/plugins/admsurban/icon.png"),
-                                   u"Open an UPL", self.iface.mainWindow())
+        # (the parser, its dependencies and the settings are loaded on first
+        # use, see `load`)
+        icon = QIcon(os.path.join(self.plugin_dir, 'icon.png'))
+        self.action_open = QAction(icon, u"Open an UPL",
+                                   self.iface.mainWindow())
         self.action_open.triggered.connect(self.run_open)  # connect with method
 
+        self.action_diff = QAction(icon, u"Compare two UPL",
+                                   self.iface.mainWindow())
+        self.action_diff.triggered.connect(self.run_diff)
+
+        self.action_reproj = QAction(icon, u"Change the CRS of UPL layers",
+                                     self.iface.mainWindow())
+        self.action_reproj.triggered.connect(self.run_reproject)
+
         # Add buttons to the toolbar
         self.toolbar.addAction(self.action_open)
+        self.toolbar.addAction(self.action_diff)
+        self.toolbar.addAction(self.action_reproj)
+
+        # Forget removed layers
+        QgsMapLayerRegistry.instance().layersWillBeRemoved.connect(
+            self.remove_layers)
 
     def unload(self):
+        QgsMapLayerRegistry.instance().layersWillBeRemoved.disconnect(
+            self.remove_layers)
         # Remove the toolbar
         del self.toolbar
 
+    def load(self):
+        """ Load translations, the parser and the cache on first use. """
+        if self.admsurban is not None:
+            return
+
+        # initialize locale
+        locale = QSettings().value("locale/userLocale")[0:2]
+        localepath = os.path.join(
+            self.plugin_dir, 'i18n', 'admsurban_{}.qm'.format(locale))
+
+        if os.path.exists(localepath):
+            self.translator = QTranslator()
+            self.translator.load(localepath)
+
+            if qVersion() > '4.3.3':
+                QCoreApplication.installTranslator(self.translator)
+
+        # parser and its geometry library
+        import admsurban
+        self.admsurban = admsurban
+        size = int(QSettings().value("admsurban/cacheSizeMb", 1024))
+        self.cache = admsurban.ADMSUrbanUPLCache(size * 1024 * 1024)
+
+    def read(self, fn, **kwargs):
+        """ Read an UPL through the cache of parsed UPL. """
+        self.load()
+        upl = self.cache.read(fn, **kwargs)
+        if not self.cache.cached(fn, **kwargs):
+            msg_info("%s is too large to be kept in memory, increase the "
+                     "admsurban/cacheSizeMb setting (%d MB) to avoid parsing "
+                     "it again" % (os.path.basename(fn),
+                                   self.cache.max_bytes // (1024 * 1024)),
+                     duration=10)
+        return upl
+
+    def add_layers(self, layers, idxgp):
+        """ Add layers loaded together to the map and to a group. """
+        reg = QgsMapLayerRegistry.instance()
+        li = iface.legendInterface()
+        ids = [vl.id() for vl in layers]
+        for vl in layers:
+            reg.addMapLayer(vl)
+            li.moveLayer(vl, idxgp)
+            self.loads[vl.id()] = ids
+
+    def remove_layers(self, lids):
+        """ Forget layers removed from the map. """
+        for lid in lids:
+            ids = self.loads.pop(lid, None)
+            if ids is not None:
+                ids.remove(lid)
+
     def run_open(self):
         """ Open an UPL and create temporary layers. """
+        self.load()
         
         # Usefull variables
-        reg = QgsMapLayerRegistry.instance()
         li = iface.legendInterface()
         
         # Ask for a filename
@@ -86,9 +241,17 @@ class QGisADMSUrbanViewer:
         if not fn:
             return
         
+        # Filters
+        dlg = ADMSUrbanOpenDialog(self.iface.mainWindow())
+        if not dlg.exec_():
+            return
+        
         # Open the UPL file
-        upl = admsurban.ADMSUrbanUPL()
-        upl.read(fn)
+        upl = self.read(fn, types=dlg.types, bbox=dlg.bbox,
+                        pollutants=dlg.pollutants)
+        if not len(upl):
+            msg_info("No source selected in %s" % os.path.basename(fn))
+            return
         pols = upl.pollutants
         
         # Projection selector
@@ -105,6 +268,7 @@ class QGisADMSUrbanViewer:
         gpname = os.path.basename(fn)
         li.addGroup(gpname)
         idxgp = li.groups().index(gpname)  # index of this group
+        layers = []
 
         # __ Point sources __
         if upl.src_points:
@@ -140,8 +304,7 @@ class QGisADMSUrbanViewer:
             # Style
             vl_pts.loadNamedStyle(os.path.join(self.plugin_dir, 'style',
                                                'ponct.qml'))
-            reg.addMapLayer(vl_pts)
-            li.moveLayer(vl_pts, idxgp)
+            layers.append(vl_pts)
 
         # __ Road sources __
         if upl.src_roads:
@@ -175,8 +338,7 @@ class QGisADMSUrbanViewer:
             # Style
             vl_road.loadNamedStyle(os.path.join(self.plugin_dir, 'style',
                                                 'road.qml'))
-            reg.addMapLayer(vl_road)
-            li.moveLayer(vl_road, idxgp)
+            layers.append(vl_road)
 
         # __ Area sources __
         if upl.src_surfs:
@@ -210,8 +372,7 @@ class QGisADMSUrbanViewer:
             # Style
             vl_area.loadNamedStyle(os.path.join(self.plugin_dir, 'style',
                                                 'area.qml'))
-            reg.addMapLayer(vl_area)
-            li.moveLayer(vl_area, idxgp)
+            layers.append(vl_area)
 
         # __ Volume sources __
         if upl.src_vols:
@@ -245,8 +406,7 @@ class QGisADMSUrbanViewer:
             # Style
             vl_vol.loadNamedStyle(os.path.join(self.plugin_dir, 'style',
                                                'vol.qml'))
-            reg.addMapLayer(vl_vol)
-            li.moveLayer(vl_vol, idxgp)
+            layers.append(vl_vol)
 
         # __ Cadastre sources __
         if upl.src_cads:
@@ -280,8 +440,178 @@ class QGisADMSUrbanViewer:
             # Style
             vl_cad.loadNamedStyle(os.path.join(self.plugin_dir, 'style',
                                                'cad.qml'))
-            reg.addMapLayer(vl_cad)
-            li.moveLayer(vl_cad, idxgp)
+            layers.append(vl_cad)
+
+        self.add_layers(layers, idxgp)
 
         # End
         msg_info("%s loaded" % os.path.basename(fn), duration=5)
+
+    def run_diff(self):
+        """ Compare two UPL and create temporary layers of differences. """
+        self.load()
+
+        # Usefull variables
+        li = iface.legendInterface()
+
+        # Ask for filenames
+        fnold = QFileDialog.getOpenFileName(None, "Open reference UPL file",
+                                            "", "*.upl")
+        if not fnold:
+            return
+        fnnew = QFileDialog.getOpenFileName(None, "Open compared UPL file",
+                                            os.path.dirname(fnold), "*.upl")
+        if not fnnew:
+            return
+
+        # Open the UPL files and compare them
+        uplold = self.read(fnold)
+        uplnew = self.read(fnnew)
+        try:
+            upldiff = self.admsurban.diff(uplold, uplnew)
+        except ValueError as e:
+            msg_error(e)
+            return
+        if not len(upldiff):
+            msg_info("No difference between %s and %s" % (
+                os.path.basename(fnold), os.path.basename(fnnew)), duration=5)
+            return
+        pols = upldiff.pollutants
+
+        # Projection selector
+        projselector = QgsGenericProjectionSelector()
+        rc = projselector.exec_()
+        if not rc:
+            return
+        if not int(projselector.selectedCrsId()):
+            msg_error("Projection not selected !")
+            return
+        crs = projselector.selectedAuthId()
+
+        # Create group
+        gpname = "%s / %s" % (os.path.basename(fnold),
+                              os.path.basename(fnnew))
+        li.addGroup(gpname)
+        idxgp = li.groups().index(gpname)  # index of this group
+        layers = []
+
+        # One layer per geometry type
+        for geomtype, srctyps in (("Point", (0, )),
+                                  ("LineString", (4, )),
+                                  ("Polygon", (1, 2, 5))):
+            srcdiffs = [e for e in upldiff if e.srctyp in srctyps]
+            if not srcdiffs:
+                continue
+
+            # Create temporary layer
+            vl_diff = QgsVectorLayer(
+                "%s?index=yes&crs=%s" % (geomtype, crs),
+                "ADMS-Urban %s differences%s" % (
+                    geomtype.lower(), " (%s)" % pols[0] if pols else ""),
+                "memory")
+            pr_diff = vl_diff.dataProvider()
+            pr_diff.addAttributes([QgsField("src_name", QVariant.String),
+                                   QgsField("status", QVariant.String),
+                                   QgsField("src_type", QVariant.Int),
+                                   QgsField("geom_chg", QVariant.Int), ] +
+                                  [QgsField(e, QVariant.Double) for e in pols])
+            vl_diff.updateFields()
+
+            # Add features
+            fets = []
+            for srcdiff in srcdiffs:
+                fet = QgsFeature()
+                fet.setGeometry(QgsGeometry.fromWkt(srcdiff.geom.wkt))
+                fet.setAttributes(
+                    [srcdiff.srcname, srcdiff.status, srcdiff.srctyp,
+                     int(srcdiff.geom_changed)] +
+                    [srcdiff.srcdelta.get(p) for p in pols])
+                fets.append(fet)
+            pr_diff.addFeatures(fets)
+            del fets
+            vl_diff.updateExtents()
+
+            # Style by delta of the first pollutant, with classes symmetric
+            # around 0 (the first matching class is drawn, so 0 is white)
+            if pols:
+                dmax = max(abs(e.srcdelta[pols[0]]) for e in srcdiffs)
+                ranges = []
+                for lower, upper, color in (
+                        (0., 0., QColor(255, 255, 255)),
+                        (-dmax, -dmax / 2, QColor(0, 0, 255)),
+                        (-dmax / 2, 0., QColor(150, 150, 255)),
+                        (0., dmax / 2, QColor(255, 150, 150)),
+                        (dmax / 2, dmax, QColor(255, 0, 0))):
+                    if dmax == 0. and ranges:
+                        break
+                    symbol = QgsSymbolV2.defaultSymbol(vl_diff.geometryType())
+                    symbol.setColor(color)
+                    label = ("%g - %g" % (lower, upper) if lower != upper
+                             else "0")
+                    ranges.append(QgsRendererRangeV2(lower, upper, symbol,
+                                                     label))
+                vl_diff.setRendererV2(
+                    QgsGraduatedSymbolRendererV2(pols[0], ranges))
+
+            layers.append(vl_diff)
+
+        self.add_layers(layers, idxgp)
+
+        # End
+        msg_info("%s, styled by %s delta" % (upldiff, pols[0]) if pols
+                 else "%s" % upldiff, duration=5)
+
+    def run_reproject(self):
+        """ Change the CRS of the layers loaded with the active layer. """
+
+        # Usefull variables
+        reg = QgsMapLayerRegistry.instance()
+
+        # Layers loaded with the active layer
+        vl = self.iface.activeLayer()
+        if vl is None or vl.id() not in self.loads:
+            msg_error("Select a layer loaded from an UPL !")
+            return
+        layers = [reg.mapLayer(e) for e in self.loads[vl.id()]]
+        layers = [e for e in layers if e is not None]
+
+        # Projection selector
+        projselector = QgsGenericProjectionSelector()
+        rc = projselector.exec_()
+        if not rc:
+            return
+        if not int(projselector.selectedCrsId()):
+            msg_error("Projection not selected !")
+            return
+        crs = QgsCoordinateReferenceSystem(
+            projselector.selectedCrsId(),
+            QgsCoordinateReferenceSystem.InternalCrsId)
+
+        # Transform coordinates or only assign the CRS
+        rc = QMessageBox.question(
+            self.iface.mainWindow(), "ADMS-Urban",
+            "Transform the coordinates to %s ?\n\nChoose No to only assign "
+            "this CRS to the layers (wrong CRS selected at opening)." %
+            crs.authid(),
+            QMessageBox.Yes | QMessageBox.No | QMessageBox.Cancel)
+        if rc == QMessageBox.Cancel:
+            return
+
+        for vl in layers:
+            if rc == QMessageBox.Yes:
+                # Transform all geometries and change them in one call
+                xform = QgsCoordinateTransform(vl.crs(), crs)
+                geoms = {}
+                req = QgsFeatureRequest().setSubsetOfAttributes([])
+                for fet in vl.getFeatures(req):
+                    geom = QgsGeometry(fet.geometry())
+                    geom.transform(xform)
+                    geoms[fet.id()] = geom
+                vl.dataProvider().changeGeometryValues(geoms)
+                del geoms
+            vl.setCrs(crs)
+            vl.updateExtents()
+            vl.triggerRepaint()
+
+        # End
+        msg_info("%d layers in %s" % (len(layers), crs.authid()), duration=5)
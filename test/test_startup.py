@@ -0,0 +1,116 @@
+# coding: utf-8
+"""
+Startup cost of the plugin, run outside QGis with stubbed `qgis` and `PyQt4`:
+
+    python -m pytest test
+
+Loading the plugin and initializing its GUI must not import the parser nor
+its geometry library, and must stay fast.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import os.path
+import sys
+import time
+import types
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Maximum time to load the plugin and initialize its GUI, in seconds
+MAX_STARTUP_TIME = 0.5
+
+# Names used at module level or by `initGui`, the others are mocks
+STUBS = {
+    'PyQt4.QtCore': ['QSettings', 'QTranslator', 'QCoreApplication',
+                     'QVariant', 'Qt', 'qVersion'],
+    'PyQt4.QtGui': ['QAction', 'QIcon', 'QColor', 'QFileDialog',
+                    'QMessageBox'],
+    'qgis.core': ['QgsMapLayerRegistry', 'QgsVectorLayer'],
+    'qgis.gui': ['QgsGenericProjectionSelector', 'QgsMessageBar'],
+    'qgis.utils': ['iface'],
+}
+
+
+def load_plugin():
+    """Import the plugin package as QGis does."""
+    name = 'admsurban_viewer'
+    try:
+        import importlib.util
+    except ImportError:  # python 2
+        import imp
+        return imp.load_module(name, None, PLUGIN_DIR,
+                               ('', '', imp.PKG_DIRECTORY))
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(PLUGIN_DIR, '__init__.py'),
+        submodule_search_locations=[PLUGIN_DIR])
+    plugin = importlib.util.module_from_spec(spec)
+    sys.modules[name] = plugin
+    spec.loader.exec_module(plugin)
+    return plugin
+
+
+def stub_modules():
+    """Stub modules of QGis and PyQt4."""
+    modules = {'PyQt4': types.ModuleType('PyQt4'),
+               'qgis': types.ModuleType('qgis')}
+    for name, attrs in STUBS.items():
+        module = types.ModuleType(name)
+        for attr in attrs:
+            setattr(module, attr, mock.MagicMock(name=attr))
+        module.__all__ = list(attrs)
+        modules[name] = module
+    # base class of the dialog
+    modules['PyQt4.QtGui'].QDialog = type('QDialog', (object, ), {})
+    modules['PyQt4.QtGui'].__all__.append('QDialog')
+    return modules
+
+
+class TestStartup(unittest.TestCase):
+
+    heavy_modules = ('admsurban', 'shapely', 'numpy')
+
+    def setUp(self):
+        self.modules = dict(sys.modules)
+        self.path = list(sys.path)
+        for name in self.heavy_modules + ('qgis_admsurban', 'resources_rc'):
+            sys.modules.pop(name, None)
+        sys.modules.update(stub_modules())
+        sys.path.insert(0, PLUGIN_DIR)
+
+    def tearDown(self):
+        sys.modules.clear()
+        sys.modules.update(self.modules)
+        sys.path[:] = self.path
+
+    def test_startup(self):
+        start = time.time()
+        plugin = load_plugin()
+        viewer = plugin.classFactory(mock.MagicMock(name='iface'))
+        viewer.initGui()
+        duration = time.time() - start
+
+        for name in self.heavy_modules + ('resources_rc', ):
+            self.assertFalse(name in sys.modules,
+                             "{} imported at startup".format(name))
+        self.assertLess(duration, MAX_STARTUP_TIME)
+
+
+if __name__ == '__main__':
+    unittest.main()